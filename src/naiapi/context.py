@@ -0,0 +1,284 @@
+import re
+from collections import deque
+
+REGEX_KEY = re.compile(r"^/(.+)/([imsu]*)$", re.DOTALL)
+
+REGEX_FLAGS = {
+    "i": re.IGNORECASE,
+    "m": re.MULTILINE,
+    "s": re.DOTALL,
+    "u": 0
+}
+
+class KeywordIndex:
+    # Aho-Corasick automaton over the literal keys. Keys written as /pattern/flags
+    # can't be folded into the automaton, so they're kept aside and run as regexes.
+    # Regex keys that don't compile are collected in invalid instead of raising, so
+    # one bad key doesn't stop the rest of a lorebook from loading.
+    def __init__(self):
+        self.invalid = []
+        self.__depth__ = 1
+        self.__goto__ = [dict()]
+        self.__fail__ = [0]
+        self.__own__ = [[]]
+        self.__out__ = [[]]
+        self.__regex__ = []
+        self.__built__ = True
+
+    def add(self, key, value):
+        m = REGEX_KEY.match(key)
+        if m is not None:
+            flags = 0
+            for f in m.group(2):
+                flags |= REGEX_FLAGS[f]
+            try:
+                self.__regex__.append((re.compile(m.group(1), flags), value))
+            except re.error as e:
+                self.invalid.append((key, value, e))
+            return
+        key = key.lower()
+        if len(key) == 0:
+            return
+        node = 0
+        for c in key:
+            nxt = self.__goto__[node].get(c)
+            if nxt is None:
+                nxt = len(self.__goto__)
+                self.__goto__.append(dict())
+                self.__fail__.append(0)
+                self.__own__.append([])
+                self.__out__.append([])
+                self.__goto__[node][c] = nxt
+            node = nxt
+        self.__own__[node].append((len(key), value))
+        self.__depth__ = max(self.__depth__, len(key))
+        self.__built__ = False
+
+    def build(self):
+        queue = list(self.__goto__[0].values())
+        for node in queue:
+            self.__fail__[node] = 0
+            self.__out__[node] = self.__own__[node]
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            for c, child in self.__goto__[node].items():
+                queue.append(child)
+                f = self.__fail__[node]
+                while f and c not in self.__goto__[f]:
+                    f = self.__fail__[f]
+                f = self.__goto__[f].get(c, 0)
+                self.__fail__[child] = f
+                self.__out__[child] = self.__own__[child] + self.__out__[f]
+        self.__built__ = True
+
+    def has_regex(self):
+        return len(self.__regex__) > 0
+
+    # Feeds text into the automaton starting from a saved state (None to start
+    # fresh), recording the latest start position of each value in hits. Returns the
+    # state to resume from. Characters are lowered one at a time and the original
+    # index of each lowered character is remembered, since lowering can lengthen
+    # the text ("İ" becomes two characters) and positions must stay in the original.
+    def scan(self, text, offset=0, state=None, hits=None):
+        if not self.__built__:
+            self.build()
+        if hits is None:
+            hits = dict()
+        if state is None:
+            state = (0, deque(maxlen=self.__depth__))
+        node, recent = state
+        goto = self.__goto__
+        fail = self.__fail__
+        out = self.__out__
+        pos = offset
+        for c in text:
+            for l in c.lower():
+                recent.append(pos)
+                while node and l not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(l, 0)
+                for length, value in out[node]:
+                    start = recent[-length]
+                    if hits.get(value, -1) < start:
+                        hits[value] = start
+            pos += 1
+        return (node, recent)
+
+    # Searches from offset within the full text so anchors, word boundaries and
+    # lookbehinds still see the characters before the window.
+    def scan_regex(self, text, offset=0, hits=None):
+        if hits is None:
+            hits = dict()
+        for pattern, value in self.__regex__:
+            last = None
+            for m in pattern.finditer(text, offset):
+                last = m
+            if last is not None:
+                start = last.start()
+                if hits.get(value, -1) < start:
+                    hits[value] = start
+        return hits
+
+class LoreEntry:
+    def __init__(self,
+                text,
+                keys=None,
+                search_range=1000,
+                enabled=True,
+                force_activation=False,
+                insertion_order=400,
+                insertion_position=-1,
+                display_name=None):
+        self.text = text
+        self.keys = keys if keys is not None else []
+        self.search_range = search_range
+        self.enabled = enabled
+        self.force_activation = force_activation
+        self.insertion_order = insertion_order
+        self.insertion_position = insertion_position
+        self.display_name = display_name
+
+    def from_json(entry):
+        config = entry.get("contextConfig", {})
+        return LoreEntry(entry.get("text", ""),
+                        keys=entry.get("keys", []),
+                        search_range=entry.get("searchRange", 1000),
+                        enabled=entry.get("enabled", True),
+                        force_activation=entry.get("forceActivation", False),
+                        insertion_order=config.get("budgetPriority", 400),
+                        insertion_position=config.get("insertionPosition", -1),
+                        display_name=entry.get("displayName"))
+
+class LoreScanner:
+    # Keeps the automaton state at the end of the last scanned text so appended
+    # text can be scanned on its own instead of re-reading the whole window.
+    def __init__(self, entries):
+        self.entries = [e for e in entries if e.enabled]
+        self.__index__ = KeywordIndex()
+        self.__max_range__ = 0
+        for i, entry in enumerate(self.entries):
+            for key in entry.keys:
+                self.__index__.add(key, i)
+            if entry.search_range > self.__max_range__:
+                self.__max_range__ = entry.search_range
+        self.__index__.build()
+        self.invalid_keys = self.__index__.invalid
+        self.reset()
+
+    def reset(self):
+        self.__text__ = ""
+        self.__state__ = None
+        self.__hits__ = dict()
+
+    def scan(self, text):
+        if len(text) >= len(self.__text__) and text.startswith(self.__text__):
+            new = text[len(self.__text__):]
+            offset = len(self.__text__)
+            # Anything before the window can't trigger an entry, so a long
+            # append restarts the automaton at the window edge.
+            window = len(text) - self.__max_range__
+            if window > offset:
+                new = text[window:]
+                offset = window
+                self.__state__ = None
+        else:
+            self.reset()
+            offset = max(0, len(text) - self.__max_range__)
+            new = text[offset:]
+        self.__state__ = self.__index__.scan(new, offset, self.__state__, self.__hits__)
+        self.__text__ = text
+
+        hits = self.__hits__
+        if self.__index__.has_regex():
+            # Regex matches can't be resumed from a saved state, so regex keys
+            # are rechecked over the window on every scan.
+            hits = dict(hits)
+            window = max(0, len(text) - self.__max_range__)
+            self.__index__.scan_regex(text, window, hits)
+
+        triggered = []
+        for i, entry in enumerate(self.entries):
+            if entry.force_activation:
+                triggered.append(entry)
+                continue
+            start = hits.get(i)
+            if start is not None and start >= len(text) - entry.search_range:
+                triggered.append(entry)
+        return triggered
+
+class ContextBuilder:
+    def __init__(self, entries=None, memory=None, authors_note=None):
+        self.memory = memory
+        self.authors_note = authors_note
+        self.set_entries(entries if entries is not None else [])
+
+    def set_entries(self, entries):
+        self.entries = list(entries)
+        self.__scanner__ = LoreScanner(self.entries)
+
+    def load_lorebook(self, lorebook):
+        self.set_entries([LoreEntry.from_json(e) for e in lorebook.get("entries", [])])
+
+    def scan(self, story):
+        return self.__scanner__.scan(story)
+
+    # Builds the input for NAIApi.generate. Memory and the author's note are placed
+    # first, then triggered entries by descending insertion_order while they fit,
+    # and the story is trimmed from the top to fill whatever budget is left.
+    # length defaults to characters; pass a token counter to budget in tokens.
+    def build(self, story, budget, length=len):
+        inserts = []
+        if self.memory:
+            inserts.append(LoreEntry(self.memory, insertion_order=800, insertion_position=0))
+        if self.authors_note:
+            inserts.append(LoreEntry(self.authors_note, insertion_order=-400, insertion_position=-4))
+        remaining = budget
+        for entry in inserts:
+            remaining -= length(entry.text) + 1
+        if remaining < 0:
+            raise ValueError("Memory and author's note exceed the context budget.")
+
+        triggered = sorted(self.scan(story), key=lambda e: -e.insertion_order)
+        for entry in triggered:
+            cost = length(entry.text) + 1
+            if cost <= remaining:
+                inserts.append(entry)
+                remaining -= cost
+
+        story = ContextBuilder.__trim__(story, remaining, length)
+        lines = story.split("\n") if story else []
+        slots = dict()
+        # Positions count lines from the top, or from the bottom when negative:
+        # 0 is above the first line and -1 is just above the newest line.
+        for entry in sorted(inserts, key=lambda e: -e.insertion_order):
+            pos = entry.insertion_position
+            if pos < 0:
+                pos = len(lines) + pos
+            pos = min(max(pos, 0), len(lines))
+            slots.setdefault(pos, []).append(entry.text)
+
+        result = []
+        for i in range(len(lines) + 1):
+            result.extend(slots.get(i, []))
+            if i < len(lines):
+                result.append(lines[i])
+        return "\n".join(result)
+
+    def __trim__(story, budget, length):
+        if budget <= 0:
+            return ""
+        if length(story) <= budget:
+            return story
+        lo, hi = 0, len(story)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if length(story[mid:]) <= budget:
+                hi = mid
+            else:
+                lo = mid + 1
+        nl = story.find("\n", lo)
+        if story[lo - 1] != "\n" and nl != -1 and nl + 1 < len(story):
+            lo = nl + 1
+        return story[lo:]
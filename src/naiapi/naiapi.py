@@ -5,6 +5,12 @@ from passlib.hash import argon2
 import base64
 import nacl.secret
 import nacl.utils
+import time
+import socket
+import threading
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 class NAIApi:
     __base_url__ = "https://api.novelai.net/"
@@ -12,6 +18,7 @@ class NAIApi:
     __token__ = None
     __header__ = None
     __keystore__ = None
+    __keystore_change_index__ = 0
 
     def load_saved_credentials(encryption_key, access_key, token):
         NAIApi.set_keys(encryption_key, access_key)
@@ -94,6 +101,7 @@ class NAIApi:
             sb = nacl.secret.SecretBox(NAIApi.__keys__["encryption_key"])
             k = sb.decrypt(sdata, nonce)
             NAIApi.__keystore__ = json.loads(k.decode("UTF-8"))["keys"]
+            NAIApi.__keystore_change_index__ = response.get("changeIndex", 0)
         else:
             raise ex
 
@@ -171,7 +179,130 @@ class NAIApi:
         sb = nacl.secret.SecretBox(key)
         return sb.decrypt(sdata, nonce)
 
-    def generate(input, model, preset=None, params=None, module=None, get_stream=False):
+    def __encode_secret_box__(data, key):
+        sb = nacl.secret.SecretBox(key)
+        return bytes(sb.encrypt(data, nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)))
+
+    def __put_keystore__():
+        nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
+        k = json.dumps({"keys": NAIApi.__keystore__}).encode("UTF-8")
+        sb = nacl.secret.SecretBox(NAIApi.__keys__["encryption_key"])
+        sdata = sb.encrypt(k, nonce).ciphertext
+        keystore = json.dumps({"version": 2, "nonce": list(nonce), "sdata": list(sdata)})
+        body = {
+            "keystore": base64.b64encode(keystore.encode("UTF-8")).decode("ascii"),
+            "changeIndex": NAIApi.__keystore_change_index__
+        }
+        api_url = NAIApi.__base_url__ + "user/keystore"
+        response = requests.put(api_url, json=body, headers=NAIApi.__header__)
+        ex = response_code_exception(response)
+        if ex is None:
+            NAIApi.__keystore_change_index__ += 1
+        else:
+            raise ex
+
+    # Uploads objects of type t as new user objects over a pooled session with at
+    # most concurrency requests in flight. Failures don't stop the batch; each one
+    # is reported alongside the index of the object it belongs to.
+    def __put_objects__(t, objects, concurrency=8):
+        api_url = NAIApi.__base_url__ + "user/objects/" + t
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        session.mount(NAIApi.__base_url__, adapter)
+        session.headers.update(NAIApi.__header__)
+
+        def put(obj):
+            response = session.put(api_url, json=obj)
+            ex = response_code_exception(response)
+            if ex is not None:
+                raise ex
+            return response.json()
+
+        uploaded = []
+        failed = []
+        with session, ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(put, obj) for obj in objects]
+            for i, future in enumerate(futures):
+                try:
+                    uploaded.append((i, future.result()))
+                except Exception as e:
+                    failed.append((i, e))
+        return {"uploaded": uploaded, "failed": failed}
+
+    # presets is {name: Params}, (name, Params) pairs, or the {id: {"name", "preset"}}
+    # mapping get_custom_presets returns, in which case the source ids are kept.
+    def upload_custom_presets(presets, model=None, concurrency=8):
+        if not NAIApi.is_logged_in():
+            return None
+        if isinstance(presets, dict):
+            presets = list(presets.items())
+        objects = []
+        for key, value in presets:
+            if isinstance(value, dict):
+                name, params, preset_id = value["name"], value["preset"], key
+            else:
+                name, params, preset_id = key, value, None
+            data = params.export_preset(name, preset_id=preset_id, model=model)
+            objects.append({
+                "meta": data["id"],
+                "data": base64.b64encode(json.dumps(data).encode("UTF-8")).decode("ascii")
+            })
+        return NAIApi.__put_objects__("presets", objects, concurrency)
+
+    # Each module gets its own keystore key, as the web client does. The keystore is
+    # saved once before anything is uploaded so no module is left unreadable. Keys of
+    # modules that then fail to encrypt or upload are removed again; if that last
+    # keystore save fails they're listed under "orphaned_keys".
+    def upload_custom_modules(modules, workers=None, concurrency=8):
+        if not NAIApi.is_logged_in():
+            return None
+        modules = list(modules)
+        metas = []
+        for module in modules:
+            meta = str(uuid.uuid4())
+            NAIApi.__keystore__[meta] = list(nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE))
+            metas.append(meta)
+        try:
+            NAIApi.__put_keystore__()
+        except Exception:
+            for meta in metas:
+                del NAIApi.__keystore__[meta]
+            raise
+
+        def encrypt(args):
+            module, meta = args
+            data = json.dumps(module).encode("UTF-8")
+            sdata = NAIApi.__encode_secret_box__(data, bytes(NAIApi.__keystore__[meta]))
+            return {
+                "meta": meta,
+                "data": base64.b64encode(sdata).decode("ascii")
+            }
+
+        failed = []
+        encrypted = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(encrypt, args) for args in zip(modules, metas)]
+            for i, future in enumerate(futures):
+                try:
+                    encrypted.append((i, future.result()))
+                except Exception as e:
+                    failed.append((i, e))
+        result = NAIApi.__put_objects__("aimodules", [obj for _, obj in encrypted], concurrency)
+        uploaded = [(encrypted[j][0], obj) for j, obj in result["uploaded"]]
+        failed += [(encrypted[j][0], e) for j, e in result["failed"]]
+        failed.sort(key=lambda f: f[0])
+
+        orphaned = [metas[i] for i, _ in failed]
+        if orphaned:
+            keys = {meta: NAIApi.__keystore__.pop(meta) for meta in orphaned}
+            try:
+                NAIApi.__put_keystore__()
+                orphaned = []
+            except Exception:
+                NAIApi.__keystore__.update(keys)
+        return {"uploaded": uploaded, "failed": failed, "orphaned_keys": orphaned}
+
+    def __generate_request__(input, model, preset, params, module, get_stream):
         model = model.capitalize()
         if preset is None and params is None:
             preset = PRESETS[model][0]
@@ -194,12 +325,310 @@ class NAIApi:
             "model": MODELS[model],
             "parameters": params.export()
         }
-        response = requests.post(api_url, json=body, headers=NAIApi.__header__)
-        ex = response_code_exception(response)
-        if ex is None:
-            return response.json()
+        return api_url, body
+
+    def generate(input, model, preset=None, params=None, module=None, get_stream=False, timeout=None, deadline=None, stop=None):
+        return NAIApi.generate_handle(input, model, preset, params, module, get_stream, timeout, deadline, stop).result()
+
+    def generate_handle(input, model, preset=None, params=None, module=None, get_stream=False, timeout=None, deadline=None, stop=None):
+        api_url, body = NAIApi.__generate_request__(input, model, preset, params, module, get_stream)
+        return GenerationHandle(api_url, body, NAIApi.__header__, get_stream, timeout, deadline, stop)
+
+    def generate_async(input, model, preset=None, params=None, module=None, get_stream=False, timeout=None, deadline=None, stop=None):
+        return AsyncGenerationHandle(NAIApi.generate_handle(input, model, preset, params, module, get_stream, timeout, deadline, stop))
+
+class SocketTrackingAdapter(requests.adapters.HTTPAdapter):
+    # Reports every socket as soon as it connects, so a request still waiting for
+    # response headers can be interrupted by shutting its socket down.
+    def __init__(self, on_connect, **kwargs):
+        self.on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        on_connect = self.on_connect
+        pool_classes = dict()
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            class TrackedConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    super().connect()
+                    on_connect(self.sock)
+            pool_classes[scheme] = type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": TrackedConnection})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+class GenerationHandle:
+    # timeout is relative to creation, deadline is an absolute time.monotonic() value;
+    # the earlier of the two bounds the connect and read timeouts and closes the
+    # connection once it passes. stop is a list of strings or a callable taking the
+    # text generated so far, and ends a stream early once it matches.
+    def __init__(self, api_url, body, headers, get_stream=False, timeout=None, deadline=None, stop=None):
+        self.api_url = api_url
+        self.body = body
+        self.headers = headers
+        self.get_stream = get_stream
+        if timeout is not None:
+            t = time.monotonic() + timeout
+            deadline = t if deadline is None else min(deadline, t)
+        self.deadline = deadline
+        if stop is not None and not get_stream:
+            raise ValueError("stop conditions are only supported for streamed generations.")
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stop = stop
+        # Text that could still be the start of a stop string is held back until the
+        # next token shows whether it matches, so nothing yielded is later trimmed.
+        if stop is None or callable(stop):
+            self.__holdback__ = 0
         else:
+            self.__holdback__ = max([len(s) for s in stop] + [1]) - 1
+        self.stopped = False
+        self.__lock__ = threading.Lock()
+        self.__sockets__ = []
+        self.__session__ = requests.Session()
+        adapter = SocketTrackingAdapter(self.__track__)
+        self.__session__.mount("http://", adapter)
+        self.__session__.mount("https://", adapter)
+        self.__response__ = None
+        self.__timer__ = None
+        self.__cancelled__ = False
+        self.__started__ = False
+        self.__result__ = None
+        self.__error__ = None
+        self.__done__ = threading.Event()
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def cancel(self):
+        with self.__lock__:
+            if self.__done__.is_set():
+                return False
+            self.__cancelled__ = True
+        return self.__finish__(error=CancelledError("Generation was cancelled."))
+
+    def cancelled(self):
+        return self.__cancelled__
+
+    def done(self):
+        return self.__done__.is_set()
+
+    def __expire__(self):
+        self.__finish__(error=DeadlineExceededError("Generation deadline exceeded."))
+
+    def __track__(self, sock):
+        with self.__lock__:
+            self.__sockets__.append(sock)
+            closed = self.__done__.is_set()
+        if closed:
+            GenerationHandle.__shutdown__(sock)
+
+    def __shutdown__(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __close__(self):
+        if self.__timer__ is not None:
+            self.__timer__.cancel()
+        # Closing the response or session doesn't wake a thread blocked in a read,
+        # so shut the sockets down underneath it first.
+        with self.__lock__:
+            sockets = list(self.__sockets__)
+        for sock in sockets:
+            GenerationHandle.__shutdown__(sock)
+        response = self.__response__
+        if response is not None:
+            response.close()
+        self.__session__.close()
+
+    def __check__(self):
+        if self.__done__.is_set() and self.__error__ is not None:
+            raise self.__error__
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceededError("Generation deadline exceeded.")
+        return remaining
+
+    def __start__(self):
+        with self.__lock__:
+            if self.__started__:
+                return False
+            self.__started__ = True
+            return True
+
+    def __open__(self):
+        remaining = self.__check__()
+        if remaining is not None:
+            self.__timer__ = threading.Timer(remaining, self.__expire__)
+            self.__timer__.daemon = True
+            self.__timer__.start()
+        try:
+            response = self.__session__.post(self.api_url, json=self.body, headers=self.headers,
+                                            timeout=remaining, stream=True)
+        except requests.exceptions.Timeout:
+            self.__check__()
+            raise DeadlineExceededError("Generation deadline exceeded.")
+        self.__response__ = response
+        self.__check__()
+        ex = response_code_exception(response)
+        if ex is not None:
             raise ex
+        return response
+
+    # Only the first outcome sticks, so a cancellation or deadline that already
+    # finished the handle wins over whatever the interrupted read raises next.
+    def __finish__(self, result=None, error=None):
+        with self.__lock__:
+            if self.__done__.is_set():
+                return False
+            self.__result__ = result
+            self.__error__ = error
+            self.__done__.set()
+        self.__close__()
+        return True
+
+    def __fail__(self, e):
+        self.__finish__(error=e)
+        if self.__error__ is not e:
+            raise self.__error__ from e
+        raise e
+
+    def tokens(self):
+        if not self.get_stream:
+            raise ValueError("tokens() is only available for streamed generations.")
+        if not self.__start__():
+            raise AlreadyStartedError("Generation handle has already been started.")
+        return self.__tokens__()
+
+    # Splits the body into lines as soon as the bytes arrive. iter_lines() waits for
+    # a full chunk_size read first, which holds tokens back until several arrive.
+    def __lines__(response):
+        if not hasattr(response.raw, "read1"):
+            # urllib3 1.x has no read1; chunk_size=None still yields each chunk as it
+            # arrives for the chunked responses the stream endpoint sends.
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                yield line
+            return
+        buffer = b""
+        while True:
+            chunk = response.raw.read1(8192, decode_content=True)
+            if not chunk:
+                break
+            buffer += chunk
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                yield line.rstrip(b"\r").decode("UTF-8")
+        if buffer:
+            yield buffer.rstrip(b"\r").decode("UTF-8")
+
+    def __tokens__(self):
+        text = ""
+        emitted = 0
+        try:
+            response = self.__open__()
+            for line in GenerationHandle.__lines__(response):
+                self.__check__()
+                if not line or not line.startswith("data:"):
+                    continue
+                data = json.loads(line[5:])
+                if "error" in data:
+                    raise UnknownError(data["error"])
+                before = len(text)
+                text += data.get("token", "")
+                end = self.__stop_index__(text, before)
+                if end is not None:
+                    self.stopped = True
+                    text = text[:end]
+                    break
+                if data.get("final"):
+                    break
+                ready = len(text) - self.__holdback__
+                if ready > emitted:
+                    yield text[emitted:ready]
+                    emitted = ready
+            if len(text) > emitted:
+                yield text[emitted:]
+        except GeneratorExit:
+            self.cancel()
+            raise
+        except Exception as e:
+            self.__fail__(e)
+        if not self.__finish__(result={"output": text}) and self.__error__ is not None:
+            raise self.__error__
+
+    def __stop_index__(self, text, before):
+        if self.stop is None:
+            return None
+        if callable(self.stop):
+            return len(text) if self.stop(text) else None
+        end = None
+        for s in self.stop:
+            i = text.find(s, max(0, before - len(s) + 1))
+            if i != -1 and (end is None or i < end):
+                end = i
+        return end
+
+    def result(self):
+        if self.__start__():
+            if self.get_stream:
+                for _ in self.__tokens__():
+                    pass
+            else:
+                try:
+                    response = self.__open__()
+                    content = response.content
+                    self.__check__()
+                    self.__finish__(result=json.loads(content))
+                except Exception as e:
+                    self.__fail__(e)
+        self.__done__.wait()
+        if self.__error__ is not None:
+            raise self.__error__
+        return self.__result__
+
+class AsyncGenerationHandle:
+    # Runs the blocking handle on the event loop's executor. Cancelling the awaiting
+    # task cancels the underlying request and closes its connection.
+    def __init__(self, handle):
+        self.handle = handle
+
+    def cancel(self):
+        return self.handle.cancel()
+
+    def cancelled(self):
+        return self.handle.cancelled()
+
+    def done(self):
+        return self.handle.done()
+
+    async def result(self):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self.handle.result)
+        except asyncio.CancelledError:
+            self.handle.cancel()
+            raise
+
+    async def tokens(self):
+        loop = asyncio.get_running_loop()
+        it = self.handle.tokens()
+        done = object()
+        try:
+            while True:
+                token = await loop.run_in_executor(None, next, it, done)
+                if token is done:
+                    break
+                yield token
+        except asyncio.CancelledError:
+            self.handle.cancel()
+            raise
+        finally:
+            if not self.handle.done():
+                self.handle.cancel()
 
 EUTERPE_BAD_WORDS_IDS = [[58],[60],[90],[92],[685],[1391],[1782],[2361],[3693],[4083],[4357],[4895],[5512],[5974],[7131],[8183],[8351],[8762],[8964],[8973],[9063],[11208],[11709],[11907],[11919],[12878],[12962],[13018],[13412],[14631],[14692],[14980],[15090],[15437],[16151],[16410],[16589],[17241],[17414],[17635],[17816],[17912],[18083],[18161],[18477],[19629],[19779],[19953],[20520],[20598],[20662],[20740],[21476],[21737],[22133],[22241],[22345],[22935],[23330],[23785],[23834],[23884],[25295],[25597],[25719],[25787],[25915],[26076],[26358],[26398],[26894],[26933],[27007],[27422],[28013],[29164],[29225],[29342],[29565],[29795],[30072],[30109],[30138],[30866],[31161],[31478],[32092],[32239],[32509],[33116],[33250],[33761],[34171],[34758],[34949],[35944],[36338],[36463],[36563],[36786],[36796],[36937],[37250],[37913],[37981],[38165],[38362],[38381],[38430],[38892],[39850],[39893],[41832],[41888],[42535],[42669],[42785],[42924],[43839],[44438],[44587],[44926],[45144],[45297],[46110],[46570],[46581],[46956],[47175],[47182],[47527],[47715],[48600],[48683],[48688],[48874],[48999],[49074],[49082],[49146],[49946],[10221],[4841],[1427],[2602,834],[29343],[37405],[35780],[2602],[50256]]
 KRAKE_BAD_WORDS_IDS = [[60],[62],[544],[683],[696],[880],[905],[1008],[1019],[1084],[1092],[1181],[1184],[1254],[1447],[1570],[1656],[2194],[2470],[2479],[2498],[2947],[3138],[3291],[3455],[3725],[3851],[3891],[3921],[3951],[4207],[4299],[4622],[4681],[5013],[5032],[5180],[5218],[5290],[5413],[5456],[5709],[5749],[5774],[6038],[6257],[6334],[6660],[6904],[7082],[7086],[7254],[7444],[7748],[8001],[8088],[8168],[8562],[8605],[8795],[8850],[9014],[9102],[9259],[9318],[9336],[9502],[9686],[9793],[9855],[9899],[9955],[10148],[10174],[10943],[11326],[11337],[11661],[12004],[12084],[12159],[12520],[12977],[13380],[13488],[13663],[13811],[13976],[14412],[14598],[14767],[15640],[15707],[15775],[15830],[16079],[16354],[16369],[16445],[16595],[16614],[16731],[16943],[17278],[17281],[17548],[17555],[17981],[18022],[18095],[18297],[18413],[18736],[18772],[18990],[19181],[20095],[20197],[20481],[20629],[20871],[20879],[20924],[20977],[21375],[21382],[21391],[21687],[21810],[21828],[21938],[22367],[22372],[22734],[23405],[23505],[23734],[23741],[23781],[24237],[24254],[24345],[24430],[25416],[25896],[26119],[26635],[26842],[26991],[26997],[27075],[27114],[27468],[27501],[27618],[27655],[27720],[27829],[28052],[28118],[28231],[28532],[28571],[28591],[28653],[29013],[29547],[29650],[29925],[30522],[30537],[30996],[31011],[31053],[31096],[31148],[31258],[31350],[31379],[31422],[31789],[31830],[32214],[32666],[32871],[33094],[33376],[33440],[33805],[34368],[34398],[34417],[34418],[34419],[34476],[34494],[34607],[34758],[34761],[34904],[34993],[35117],[35138],[35237],[35487],[35830],[35869],[36033],[36134],[36320],[36399],[36487],[36586],[36676],[36692],[36786],[37077],[37594],[37596],[37786],[37982],[38475],[38791],[39083],[39258],[39487],[39822],[40116],[40125],[41000],[41018],[41256],[41305],[41361],[41447],[41449],[41512],[41604],[42041],[42274],[42368],[42696],[42767],[42804],[42854],[42944],[42989],[43134],[43144],[43189],[43521],[43782],[44082],[44162],[44270],[44308],[44479],[44524],[44965],[45114],[45301],[45382],[45443],[45472],[45488],[45507],[45564],[45662],[46265],[46267],[46275],[46295],[46462],[46468],[46576],[46694],[47093],[47384],[47389],[47446],[47552],[47686],[47744],[47916],[48064],[48167],[48392],[48471],[48664],[48701],[49021],[49193],[49236],[49550],[49694],[49806],[49824],[50001],[50256],[0],[1]]
@@ -297,6 +726,23 @@ ORDER_IDS = {
     'typical_p': 5
 }
 
+# Neutral sampler values so exported presets carry every field presetVersion 3 expects.
+PRESET_DEFAULTS = {
+    "temperature": 1,
+    "max_length": 40,
+    "min_length": 1,
+    "top_k": 0,
+    "top_p": 1,
+    "top_a": 0,
+    "typical_p": 1,
+    "tail_free_sampling": 1,
+    "repetition_penalty": 1,
+    "repetition_penalty_range": 0,
+    "repetition_penalty_slope": 0,
+    "repetition_penalty_frequency": 0,
+    "repetition_penalty_presence": 0
+}
+
 class Params:
     def __init__(self,
                 prefix="vanilla",
@@ -638,6 +1084,32 @@ class Params:
         if p.order is not None:
             self.order = p.order
     
+    def export_preset(self, name, preset_id=None, model=None):
+        parameters = dict(PRESET_DEFAULTS)
+        parameters.update(self.export())
+        for key in ("bad_words_ids", "use_cache", "use_string", "return_full_text", "prefix"):
+            parameters.pop(key, None)
+        names = {v: k for k, v in ORDER_IDS.items()}
+        enabled = parameters.pop("order", None)
+        if enabled is None:
+            # No order means the default sampler chain, not every sampler switched off.
+            enabled = sorted(names)
+        order = [{"id": names[i], "enabled": True} for i in enabled]
+        for i in sorted(names):
+            if i not in enabled:
+                order.append({"id": names[i], "enabled": False})
+        parameters["order"] = order
+        preset = {
+            "presetVersion": 3,
+            "id": preset_id if preset_id is not None else str(uuid.uuid4()),
+            "name": name,
+            "remoteId": "",
+            "parameters": parameters
+        }
+        if model is not None:
+            preset["model"] = MODELS[model.capitalize()]
+        return preset
+
     def export(self):
         result = dict()
         if self.temperature is not None:
@@ -725,4 +1197,13 @@ class ConflictError(Exception):
     pass
 
 class UnknownError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class CancelledError(Exception):
+    pass
+
+class DeadlineExceededError(Exception):
+    pass
+
+class AlreadyStartedError(Exception):
+    pass
@@ -0,0 +1,299 @@
+import copy
+import threading
+import time
+from collections import deque
+import requests
+from .naiapi import NAIApi, Params, MODELS, PRESETS, UnknownError, DeadlineExceededError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Only failures that say something about the backend count against a model;
+# validation errors and cancellations are the caller's doing.
+BACKEND_ERRORS = (UnknownError, DeadlineExceededError,
+                  requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+class CircuitBreaker:
+    # Opens once a model has at least min_requests outcomes within window seconds
+    # and failure_ratio of them failed. After cooldown seconds a single probe is let
+    # through; its outcome closes the breaker again or restarts the cooldown.
+    def __init__(self, window=60, min_requests=5, failure_ratio=0.5, cooldown=30):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = None
+        self.times_opened = 0
+        self.__outcomes__ = deque()
+        self.__probing__ = False
+
+    def __trim__(self, now):
+        while self.__outcomes__ and self.__outcomes__[0][0] < now - self.window:
+            self.__outcomes__.popleft()
+
+    def error_rate(self, now=None):
+        self.__trim__(time.monotonic() if now is None else now)
+        if not self.__outcomes__:
+            return 0.0
+        failures = sum(1 for _, ok in self.__outcomes__ if not ok)
+        return failures / len(self.__outcomes__)
+
+    def current_state(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self.__probing__ = False
+        return self.state
+
+    def allow(self, now=None):
+        self.current_state(now)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.__probing__:
+            self.__probing__ = True
+            return True
+        return False
+
+    def release(self):
+        self.__probing__ = False
+
+    def record(self, ok, now=None):
+        now = time.monotonic() if now is None else now
+        if self.state == HALF_OPEN:
+            self.__probing__ = False
+            if ok:
+                self.state = CLOSED
+                self.__outcomes__.clear()
+            else:
+                self.__open__(now)
+            return
+        self.__outcomes__.append((now, ok))
+        self.__trim__(now)
+        if self.state == CLOSED and len(self.__outcomes__) >= self.min_requests \
+                and self.error_rate(now) >= self.failure_ratio:
+            self.__open__(now)
+
+    def __open__(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.times_opened += 1
+
+class ModelStats:
+    def __init__(self, breaker, alpha=0.2):
+        self.breaker = breaker
+        self.alpha = alpha
+        self.latency = None
+        self.latency_at = None
+        self.requests = 0
+        self.failures = 0
+        self.routed = 0
+
+    # A model that stops getting traffic keeps its last latency forever, so the
+    # estimate is only trusted for ttl seconds after the latest sample.
+    def current_latency(self, ttl, now=None):
+        now = time.monotonic() if now is None else now
+        if self.latency is None or now - self.latency_at > ttl:
+            return None
+        return self.latency
+
+    def record(self, ok, latency):
+        self.requests += 1
+        if ok:
+            self.latency_at = time.monotonic()
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = self.alpha * latency + (1 - self.alpha) * self.latency
+        else:
+            self.failures += 1
+        self.breaker.record(ok)
+
+def equivalent_preset(preset, model):
+    # The preset of model whose sampler order and temperature are closest to preset.
+    source = Params.preset(preset)
+    best = None
+    best_distance = None
+    for candidate in PRESETS[model]:
+        p = Params.preset(candidate)
+        a = set(source.order or [])
+        b = set(p.order or [])
+        distance = 1 - len(a & b) / max(len(a | b), 1)
+        if source.order == p.order:
+            distance -= 1
+        distance += abs((source.temperature or 1) - (p.temperature or 1))
+        if best_distance is None or distance < best_distance:
+            best = candidate
+            best_distance = distance
+    return best
+
+class ModelRouter:
+    # Tracks latency and errors per model in front of NAIApi.generate. With
+    # fallback=True a call may go to another model using an equivalent preset when
+    # the requested model's breaker is open, it fails, or it is latency_ratio times
+    # slower than an alternative. Latencies older than latency_ttl seconds are ignored,
+    # which sends traffic back to the requested model so it can show it recovered.
+    # equivalents overrides the preset pairing as
+    # {(model, preset): (model, preset)}.
+    def __init__(self, window=60, min_requests=5, failure_ratio=0.5, cooldown=30,
+                latency_ratio=2.0, latency_ttl=30, equivalents=None, listener=None, history=100):
+        self.latency_ratio = latency_ratio
+        self.latency_ttl = latency_ttl
+        self.equivalents = equivalents if equivalents is not None else {}
+        self.listener = listener
+        self.fallbacks = 0
+        self.rejected = 0
+        self.decisions = deque(maxlen=history)
+        self.__lock__ = threading.Lock()
+        self.__stats__ = dict()
+        for model in MODELS:
+            self.__stats__[model] = ModelStats(CircuitBreaker(window, min_requests, failure_ratio, cooldown))
+
+    def __candidates__(self, model, preset, module, fallback):
+        candidates = [(model, preset)]
+        if not fallback:
+            return candidates
+        # Custom modules are trained for one model, so they can't be carried over.
+        if module is not None and module.startswith(MODELS[model]):
+            return candidates
+        for other in MODELS:
+            if other == model:
+                continue
+            pair = self.equivalents.get((model, preset))
+            if pair is None or pair[0] != other:
+                pair = (other, equivalent_preset(preset, other))
+            candidates.append(pair)
+        return candidates
+
+    def __order__(self, candidates):
+        now = time.monotonic()
+        first = self.__stats__[candidates[0][0]].current_latency(self.latency_ttl, now)
+        if first is None:
+            return candidates
+        faster = []
+        for c in candidates[1:]:
+            latency = self.__stats__[c[0]].current_latency(self.latency_ttl, now)
+            if latency is not None and first > self.latency_ratio * latency:
+                faster.append(c)
+        if not faster:
+            return candidates
+        return faster + [c for c in candidates if c not in faster]
+
+    # Token ids only mean something to the tokenizer of the model they were written
+    # for. Caller-chosen biases and whitelists can't be translated, so they rule
+    # fallback out; banned ids and the prefix are cleared by __portable_params__ so
+    # the fallback preset supplies its own.
+    def __can_fall_back__(params):
+        if params is None:
+            return True
+        return params.logit_bias is None and params.logit_bias_groups is None \
+            and params.repetition_penalty_whitelist is None
+
+    def __portable_params__(params):
+        if params is None:
+            return None
+        params = copy.copy(params)
+        params.bad_words_ids = None
+        params.prefix = None
+        return params
+
+    def __decide__(self, decision):
+        self.decisions.append(decision)
+        if self.listener is not None:
+            self.listener(decision)
+
+    # timeout and deadline cover the whole call, fallbacks included: they become one
+    # absolute deadline that every attempt shares.
+    def generate(self, input, model, preset=None, params=None, module=None, fallback=False,
+                timeout=None, deadline=None, **kwargs):
+        model = model.capitalize()
+        if timeout is not None:
+            t = time.monotonic() + timeout
+            deadline = t if deadline is None else min(deadline, t)
+        if preset is None and params is None:
+            preset = PRESETS[model][0]
+        # Without a named preset there is nothing to map onto another model.
+        fallback = fallback and preset is not None and ModelRouter.__can_fall_back__(params)
+        candidates = self.__candidates__(model, preset, module, fallback)
+        with self.__lock__:
+            candidates = self.__order__(candidates)
+        last_error = None
+        for target, target_preset in candidates:
+            stats = self.__stats__[target]
+            if deadline is not None and deadline <= time.monotonic():
+                # Out of time before this attempt reached the backend; that says
+                # nothing about the model, so nothing is recorded against it.
+                with self.__lock__:
+                    self.__decide__({"model": target, "preset": target_preset,
+                                    "action": "skipped", "reason": "deadline"})
+                if last_error is None:
+                    last_error = DeadlineExceededError("Generation deadline exceeded.")
+                break
+            with self.__lock__:
+                allowed = stats.breaker.allow()
+                reason = "requested" if target == model else "fallback"
+                if not allowed:
+                    self.__decide__({"model": target, "preset": target_preset,
+                                    "action": "skipped", "reason": "circuit_" + stats.breaker.state})
+                    continue
+                stats.routed += 1
+                if target != model:
+                    self.fallbacks += 1
+                self.__decide__({"model": target, "preset": target_preset,
+                                "action": "routed", "reason": reason})
+            start = time.monotonic()
+            try:
+                if target == model:
+                    result = NAIApi.generate(input, target, target_preset, params, module,
+                                             deadline=deadline, **kwargs)
+                else:
+                    result = NAIApi.generate(input, target, target_preset,
+                                             ModelRouter.__portable_params__(params), None,
+                                             deadline=deadline, **kwargs)
+            except BACKEND_ERRORS as e:
+                with self.__lock__:
+                    stats.record(False, time.monotonic() - start)
+                    self.__decide__({"model": target, "preset": target_preset,
+                                    "action": "failed", "reason": type(e).__name__})
+                last_error = e
+                continue
+            except Exception:
+                with self.__lock__:
+                    # A probe that fails for the caller's reasons still has to
+                    # release the half-open slot.
+                    stats.breaker.release()
+                raise
+            with self.__lock__:
+                stats.record(True, time.monotonic() - start)
+            return result
+        if last_error is not None:
+            raise last_error
+        with self.__lock__:
+            self.rejected += 1
+        raise CircuitOpenError("No model available for " + model + "; circuit breaker is open.")
+
+    def metrics(self):
+        with self.__lock__:
+            models = dict()
+            for model, stats in self.__stats__.items():
+                breaker = stats.breaker
+                models[model] = {
+                    "state": breaker.current_state(),
+                    "times_opened": breaker.times_opened,
+                    "error_rate": breaker.error_rate(),
+                    "latency": stats.latency,
+                    "latency_age": None if stats.latency_at is None else time.monotonic() - stats.latency_at,
+                    "requests": stats.requests,
+                    "failures": stats.failures,
+                    "routed": stats.routed
+                }
+            return {
+                "models": models,
+                "fallbacks": self.fallbacks,
+                "rejected": self.rejected,
+                "decisions": list(self.decisions)
+            }
+
+class CircuitOpenError(Exception):
+    pass